@@ -1,4 +1,6 @@
 # pylint: disable=C0301
+# The whole API is deliberately kept in this one module, so it runs past the default length limit
+# pylint: disable=C0302
 
 """
 This module provides a Flask API for a meal logging application.
@@ -6,16 +8,31 @@ It interfaces with the Google Gemini AI to process natural language prompts,
 and persists meal data in a local SQLite database.
 """
 
-import json
+import atexit
+import copy
+import functools
+import hashlib
 import logging
+import logging.handlers
 import os
+import queue
+import re
 import sqlite3
+import threading
+import time
 from collections import defaultdict
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import date, timedelta
 import google.generativeai as genai
+import orjson
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from flask import Flask, jsonify, request
+from google.api_core import exceptions as google_exceptions
+from flask import Flask, Response, g, jsonify, request
+from flask_compress import Compress
 from flask_cors import CORS
+from flask_orjson import OrjsonProvider
 
 # Load environment variables from .env file before anything else
 load_dotenv()
@@ -23,19 +40,69 @@ load_dotenv()
 LOG_LEVEL_STR = os.getenv('LOG_LEVEL', 'INFO').upper()
 LOG_LEVEL = getattr(logging, LOG_LEVEL_STR, logging.INFO)
 
-logging.basicConfig(
-    level=LOG_LEVEL,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]
-)
+# Request threads only enqueue records; a background listener thread does the formatting and stream writes
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+_log_queue = queue.SimpleQueue()
+
+def _start_log_listener():
+    """Starts the thread that drains the log queue. Forked children inherit no threads, so they start their own."""
+    listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+_start_log_listener()
+os.register_at_fork(after_in_child=_start_log_listener)
+
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+# QueueHandler merges the message and args before enqueueing; the listener's formatter adds the rest
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+
+logging.basicConfig(level=LOG_LEVEL, handlers=[_queue_handler])
 logger = logging.getLogger(__name__)
 logger.info("Logging level set to %s", LOG_LEVEL_STR)
 
 DB_FILE = 'meals.db'
+# Number of idle connections kept open for reuse between requests
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+DB_PAGE_SIZE = 4096
+# Prepared statements kept per pooled connection; well above the number of distinct SQL strings in this module
+DB_CACHED_STATEMENTS = 512
+# Concurrent food lookups arriving within this window share one upsert statement
+FOOD_LOADER_WINDOW_SECONDS = 0.005
+FOOD_LOADER_MAX_BATCH_SIZE = 500
+# Confirmed logs arriving within this window are inserted in one transaction
+MEAL_LOG_WRITER_WINDOW_SECONDS = 0.005
+# How long a confirmed log waits for its group commit before the request stops waiting
+MEAL_LOG_WRITER_TIMEOUT_SECONDS = 10
+# Range of a SQLite INTEGER; binding a Python int outside it raises OverflowError
+SQLITE_MIN_INTEGER = -2**63
+SQLITE_MAX_INTEGER = 2**63 - 1
+# Per-connection settings applied whenever a connection is opened
+DB_CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL", # Safe under WAL; avoids an fsync on every commit
+    "PRAGMA cache_size=-20000", # ~20MB page cache
+    "PRAGMA mmap_size=268435456", # 256MB memory-mapped I/O
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+)
 
-LATEST_SCHEMA_VERSION = 4
+LATEST_SCHEMA_VERSION = 6
 # Read model name from environment variable with a sensible default
 GEMINI_MODEL_NAME = os.getenv('GEMINI_MODEL_NAME', 'gemini-1.5-flash')
+# Upper bound on a single Gemini call, so a slow upstream cannot pin a worker thread indefinitely
+GEMINI_TIMEOUT_SECONDS = float(os.getenv('GEMINI_TIMEOUT_SECONDS', '20'))
+# gRPC multiplexes concurrent calls over one persistent HTTP/2 channel per process; 'rest' is the fallback
+GEMINI_TRANSPORT = os.getenv('GEMINI_TRANSPORT', 'grpc')
+# New Gemini calls are rejected with a 429 once in-flight calls x their average latency exceeds this many seconds.
+# Under gunicorn this is the budget for the whole server; each worker enforces an equal share of it
+GEMINI_MAX_BACKLOG_SECONDS = float(os.getenv('GEMINI_MAX_BACKLOG_SECONDS', '60'))
+# Weight of the newest call in the moving average of Gemini latency
+GEMINI_LATENCY_SMOOTHING = 0.1
+# Parsed 'log_meal' responses are reused for identical prompts for a short while
+LLM_CACHE_MAXSIZE = int(os.getenv('LLM_CACHE_MAXSIZE', '1024'))
+LLM_CACHE_TTL_SECONDS = int(os.getenv('LLM_CACHE_TTL_SECONDS', '3600'))
 
 def _run_migration_v2(cursor):
     """
@@ -61,67 +128,136 @@ def _run_migration_v2(cursor):
         logger.error("Error applying migration v2", exc_info=e)
         raise # Re-raise to ensure the transaction is rolled back
 
-def _run_migration_v3(cursor):
+def _run_migration_v4(cursor):
     """
-    Migration v3:
-    1. Changes 'log_timestamp' from DATETIME string to INTEGER (Unix epoch).
+    Migration v4:
+    1. Creates a canonical 'foods' table for items and their calories.
+    2. Rebuilds 'meal_logs' to use a foreign key 'food_id'.
     """
     try:
-        # The 'rebuild table' approach is the safest way to change column types and defaults in SQLite
+        # Create the new foods table with a unique constraint on the name
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS foods (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE,
+                calories INTEGER NOT NULL
+            )
+        ''')
+        logger.info("Migration v4: Created 'foods' table.")
+
+        # Rebuild meal_logs table to reference the new foods table.
+        # This approach is safe for an empty database as per the user's context.
+        # init_db() turns foreign key enforcement off for the whole migration.
         cursor.execute('''
-            CREATE TABLE meal_logs_new (
+            CREATE TABLE meal_logs_v4 (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 log_timestamp INTEGER NOT NULL DEFAULT (strftime('%s', 'now')),
                 meal_date DATE NOT NULL,
-                food TEXT NOT NULL,
+                food_id INTEGER NOT NULL,
                 meal TEXT NOT NULL,
                 quantity INTEGER NOT NULL,
-                total_calories INTEGER
+                total_calories INTEGER,
+                FOREIGN KEY (food_id) REFERENCES foods (id)
             )
         ''')
-        logger.info("Migration v3: Created new temporary table.")
-
-        # Copy data, converting the timestamp
-        cursor.execute('''
-            INSERT INTO meal_logs_new (id, log_timestamp, meal_date, food, meal, quantity, total_calories)
-            SELECT id, strftime('%s', log_timestamp), meal_date, food, meal, quantity, total_calories
-            FROM meal_logs
-        ''')
-        logger.info("Migration v3: Migrated data to new table.")
-
         cursor.execute("DROP TABLE meal_logs")
-        logger.info("Migration v3: Dropped old table.")
-
-        cursor.execute("ALTER TABLE meal_logs_new RENAME TO meal_logs")
-        logger.info("Migration v3: Renamed new table.")
+        cursor.execute("ALTER TABLE meal_logs_v4 RENAME TO meal_logs")
+        logger.info("Migration v4: Rebuilt 'meal_logs' table with 'food_id' foreign key.")
     except sqlite3.Error as e:
-        logger.error("Error applying migration v3", exc_info=e)
+        logger.error("Error applying migration v4", exc_info=e)
         raise
 
-def _run_migration_v4(cursor):
+def _create_meal_logs_indexes(cursor):
+    """Creates the 'meal_logs' indexes if they are missing. Run after any bulk copy into the table."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_meal_logs_date_ts ON meal_logs (meal_date, log_timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_meal_logs_food_id ON meal_logs (food_id)")
+
+def _run_migration_v3_to_v6_fused(cursor):
     """
-    Migration v4:
-    1. Creates a canonical 'foods' table for items and their calories.
-    2. Rebuilds 'meal_logs' to use a foreign key 'food_id'.
+    Migrations v3 to v6 as a single table rebuild, for databases older than v3:
+    1. Changes 'log_timestamp' from DATETIME string to INTEGER (Unix epoch).
+    2. Creates a canonical 'foods' table from the distinct logged food names.
+    3. Rebuilds 'meal_logs' to use a foreign key 'food_id', copying every row only once.
+    4. Builds the v5 indexes, and leaves 'id' without AUTOINCREMENT as in v6.
     """
     try:
-        # Create the new foods table with a unique constraint on the name
+        # Indexes are only built once the bulk copies are done, instead of being updated row by row
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS foods (
+            CREATE TABLE foods (
                 id INTEGER PRIMARY KEY,
-                name TEXT NOT NULL UNIQUE,
+                name TEXT NOT NULL,
                 calories INTEGER NOT NULL
             )
         ''')
-        logger.info("Migration v4: Created 'foods' table.")
+        # Seed each food's per-item calories from its logged totals; GROUP BY keeps names distinct
+        cursor.execute('''
+            INSERT INTO foods (name, calories)
+            SELECT food, COALESCE(MAX(total_calories / quantity), 0)
+            FROM meal_logs
+            GROUP BY food
+        ''')
+        cursor.execute("CREATE UNIQUE INDEX idx_foods_name ON foods (name)")
+        logger.info("Migration v3-v6: Created and populated 'foods' table.")
 
-        # Rebuild meal_logs table to reference the new foods table.
-        # This approach is safe for an empty database as per the user's context.
-        cursor.execute("PRAGMA foreign_keys=off")
+        # The 'rebuild table' approach is the safest way to change column types and defaults in SQLite
+        cursor.execute('''
+            CREATE TABLE meal_logs_v6 (
+                id INTEGER PRIMARY KEY,
+                log_timestamp INTEGER NOT NULL DEFAULT (strftime('%s', 'now')),
+                meal_date DATE NOT NULL,
+                food_id INTEGER NOT NULL,
+                meal TEXT NOT NULL,
+                quantity INTEGER NOT NULL,
+                total_calories INTEGER,
+                FOREIGN KEY (food_id) REFERENCES foods (id)
+            )
+        ''')
+        # Copy data once, converting the timestamp and resolving each food name to its id.
+        # Epoch seconds come from julianday arithmetic rather than formatting and re-parsing a '%s' string.
+        # Rounding to whole milliseconds, SQLite's time resolution, absorbs floating-point error, and
+        # integer division then drops the fraction of a second, so the result matches strftime('%s').
+        cursor.execute('''
+            INSERT INTO meal_logs_v6 (id, log_timestamp, meal_date, food_id, meal, quantity, total_calories)
+            SELECT ml.id, CAST(ROUND((julianday(ml.log_timestamp) - 2440587.5) * 86400000) AS INTEGER) / 1000,
+                   ml.meal_date, f.id, ml.meal, ml.quantity, ml.total_calories
+            FROM meal_logs ml
+            JOIN foods f ON f.name = ml.food
+        ''')
+        logger.info("Migration v3-v6: Migrated data to new table.")
+
+        cursor.execute("DROP TABLE meal_logs")
+        cursor.execute("ALTER TABLE meal_logs_v6 RENAME TO meal_logs")
+        logger.info("Migration v3-v6: Rebuilt 'meal_logs' table with 'food_id' foreign key.")
 
+        _create_meal_logs_indexes(cursor)
+        logger.info("Migration v3-v6: Created indexes on 'meal_logs'.")
+    except sqlite3.Error as e:
+        logger.error("Error applying migrations v3-v6", exc_info=e)
+        raise
+
+def _run_migration_v5(cursor):
+    """
+    Migration v5:
+    1. Indexes 'meal_logs' for the per-day listing and the 'food_id' join.
+    init_db() refreshes planner statistics once every migration has run, so the new indexes are used.
+    """
+    try:
+        _create_meal_logs_indexes(cursor)
+        logger.info("Migration v5: Created indexes on 'meal_logs'.")
+    except sqlite3.Error as e:
+        logger.error("Error applying migration v5", exc_info=e)
+        raise
+
+def _run_migration_v6(cursor):
+    """
+    Migration v6:
+    1. Rebuilds 'meal_logs' without AUTOINCREMENT, so inserts no longer update 'sqlite_sequence'.
+       'id' stays an INTEGER PRIMARY KEY and keeps being assigned from the rowid.
+    """
+    try:
         cursor.execute('''
-            CREATE TABLE meal_logs_v4 (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+            CREATE TABLE meal_logs_v6 (
+                id INTEGER PRIMARY KEY,
                 log_timestamp INTEGER NOT NULL DEFAULT (strftime('%s', 'now')),
                 meal_date DATE NOT NULL,
                 food_id INTEGER NOT NULL,
@@ -131,25 +267,185 @@ def _run_migration_v4(cursor):
                 FOREIGN KEY (food_id) REFERENCES foods (id)
             )
         ''')
+        cursor.execute('''
+            INSERT INTO meal_logs_v6 (id, log_timestamp, meal_date, food_id, meal, quantity, total_calories)
+            SELECT id, log_timestamp, meal_date, food_id, meal, quantity, total_calories
+            FROM meal_logs
+        ''')
         cursor.execute("DROP TABLE meal_logs")
-        cursor.execute("ALTER TABLE meal_logs_v4 RENAME TO meal_logs")
-        cursor.execute("PRAGMA foreign_keys=on")
-        logger.info("Migration v4: Rebuilt 'meal_logs' table with 'food_id' foreign key.")
+        cursor.execute("ALTER TABLE meal_logs_v6 RENAME TO meal_logs")
+        logger.info("Migration v6: Rebuilt 'meal_logs' table without AUTOINCREMENT.")
+
+        _create_meal_logs_indexes(cursor)
+        logger.info("Migration v6: Recreated indexes on 'meal_logs'.")
     except sqlite3.Error as e:
-        logger.error("Error applying migration v4", exc_info=e)
+        logger.error("Error applying migration v6", exc_info=e)
         raise
 
-def init_db():
+def _remove_orphaned_meal_logs(cursor):
+    """
+    Deletes meal logs whose food_id matches no food, as reported by PRAGMA foreign_key_check.
+    Before v5 the client's food_id was stored unchecked; such entries never appeared in the daily listing.
+    """
+    orphans = cursor.execute("PRAGMA foreign_key_check(meal_logs)").fetchall()
+    if orphans:
+        logger.warning("Removing %s meal log(s) that reference a missing food.", len(orphans))
+        cursor.executemany("DELETE FROM meal_logs WHERE rowid = ?", [(rowid,) for _, rowid, _, _ in orphans])
+
+_db_pool = queue.Queue(maxsize=DB_POOL_SIZE)
+# Separate pool of read-only connections for the pure read endpoints
+_db_read_pool = queue.Queue(maxsize=DB_POOL_SIZE)
+
+def _apply_connection_pragmas(conn):
+    """Applies the performance and integrity PRAGMAs to a freshly opened connection."""
+    for pragma in DB_CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+
+def _create_connection(readonly=False):
+    """
+    Opens a new SQLite connection configured once for reuse across requests.
+    Read-only connections open the file with mode=ro, so they never take a write lock;
+    under WAL they read alongside the writer without blocking it.
+    """
+    if readonly:
+        conn = sqlite3.connect(f'file:{DB_FILE}?mode=ro', uri=True, check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
+    else:
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
+    # Make the connection return rows that can be accessed by column name
+    conn.row_factory = sqlite3.Row
+    _apply_connection_pragmas(conn)
+    return conn
+
+def _close_connection(conn, readonly=False):
+    """
+    Lets SQLite refresh planner statistics if worthwhile, then closes the connection.
+    Read-only connections cannot write statistics, so they are closed directly.
+    """
+    if not readonly:
+        try:
+            conn.execute("PRAGMA optimize")
+        except sqlite3.Error as e:
+            logger.warning("PRAGMA optimize failed", exc_info=e)
+    conn.close()
+
+@contextmanager
+def get_conn(readonly=False):
+    """
+    Borrows a connection from the pool and returns it when the block exits.
+    Pass readonly=True for blocks that only read, to borrow from the read-only pool.
+    Connections are opened lazily, so none are shared across forked workers.
+    """
+    pool = _db_read_pool if readonly else _db_pool
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _create_connection(readonly)
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback() # Never hand out a connection with a half-finished transaction
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            _close_connection(conn, readonly)
+
+@contextmanager
+def db_transaction():
+    """Borrows a pooled connection and wraps the block in a single transaction."""
+    with get_conn() as conn:
+        with conn: # Commits on success, rolls back on error
+            yield conn
+
+@atexit.register
+def close_pool():
+    """Closes every idle pooled connection when the process exits."""
+    for pool, readonly in ((_db_pool, False), (_db_read_pool, True)):
+        while True:
+            try:
+                conn = pool.get_nowait()
+            except queue.Empty:
+                break
+            _close_connection(conn, readonly)
+
+# --- SQL statements used by the request handlers ---
+# Kept as module constants so the same string objects hit each pooled connection's statement cache.
+SQL_SELECT_LOGS_FOR_DATE = """
+    SELECT
+        ml.id,
+        f.id as food_id,
+        ml.meal,
+        ml.quantity,
+        ml.total_calories,
+        f.name as food,
+        f.calories as per_item_calories
+    FROM meal_logs ml
+    JOIN foods f ON ml.food_id = f.id
+    WHERE ml.meal_date = ?
+    ORDER BY ml.log_timestamp
+"""
+# Totals use the historically stored total_calories for accuracy, counting NULLs as 0.
+# They join foods like the entry listing, so they cover exactly the entries returned.
+SQL_SELECT_MEAL_TOTALS_FOR_DATE = """
+    SELECT ml.meal, COALESCE(SUM(ml.total_calories), 0)
+    FROM meal_logs ml
+    JOIN foods f ON ml.food_id = f.id
+    WHERE ml.meal_date = ?
+    GROUP BY ml.meal
+"""
+SQL_INSERT_MEAL_LOG = "INSERT INTO meal_logs (meal_date, food_id, meal, quantity, total_calories) VALUES (?, ?, ?, ?, ?)"
+# Filled with one '(?, ?)' group per food; the no-op DO UPDATE (rather than DO NOTHING)
+# makes RETURNING yield existing rows too
+SQL_UPSERT_FOODS_TEMPLATE = """
+    INSERT INTO foods (name, calories) VALUES {values}
+    ON CONFLICT (name) DO UPDATE SET name = excluded.name
+    RETURNING name, id, calories
+"""
+SQL_SELECT_FOOD_BY_NAME = "SELECT id, calories FROM foods WHERE name = ?"
+SQL_UPDATE_FOOD_CALORIES = "UPDATE foods SET calories = ? WHERE id = ?"
+SQL_SELECT_LOG_ENTRY_DATE = "SELECT meal_date FROM meal_logs WHERE id = ?"
+# Recalculates the total from the food's canonical calories in the same statement
+SQL_UPDATE_LOG_QUANTITY = """
+    UPDATE meal_logs
+    SET quantity = ?, total_calories = (SELECT calories FROM foods WHERE id = meal_logs.food_id) * ?
+    WHERE id = ? AND meal_date = ?
+    RETURNING total_calories
+"""
+SQL_DELETE_LOG_ENTRY = "DELETE FROM meal_logs WHERE id = ? AND meal_date = ? RETURNING id"
+
+def init_db(): # pylint: disable=too-many-statements
     """Initializes and migrates the database to the latest version."""
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
 
     try:
+        # page_size can only be changed outside of WAL mode, and takes effect after a VACUUM
+        cursor.execute("PRAGMA page_size")
+        if cursor.fetchone()[0] != DB_PAGE_SIZE:
+            logger.info("Rebuilding database with a page size of %s bytes...", DB_PAGE_SIZE)
+            cursor.execute("PRAGMA journal_mode=DELETE")
+            cursor.execute(f"PRAGMA page_size={DB_PAGE_SIZE}")
+            cursor.execute("VACUUM")
+        _apply_connection_pragmas(conn)
+
         # Get current schema version using SQLite's built-in pragma
         cursor.execute("PRAGMA user_version")
         current_version = cursor.fetchone()[0]
         logger.info("Database version: %s", current_version)
 
+        migrating = current_version < LATEST_SCHEMA_VERSION
+        if migrating:
+            # Follow SQLite's procedure for rebuilding tables: enforcement is switched off (which only works
+            # outside a transaction) so rows written before it was enabled can be copied, and the keys are
+            # checked before the commit instead
+            cursor.execute("PRAGMA foreign_keys=OFF")
+            # The rebuilds are one-shot bulk writes, so skip syncing until they are committed. The journal
+            # stays in WAL: leaving it needs exclusive access, and a MEMORY journal could not roll back after a crash
+            cursor.execute("PRAGMA synchronous=OFF")
+            # Apply every pending migration in one transaction: one commit instead of one per DDL statement,
+            # and a failure rolls back to the previous version instead of leaving a half-migrated schema
+            cursor.execute("BEGIN IMMEDIATE")
+
         if current_version < 1:
             logger.info("Applying schema v1 (initial setup)...")
             cursor.execute('''
@@ -173,21 +469,42 @@ def init_db():
             logger.info("Schema v2 applied.")
 
         if current_version < 3:
-            logger.info("Applying schema v3...")
-            _run_migration_v3(cursor)
-            cursor.execute("PRAGMA user_version = 3")
-            logger.info("Schema v3 applied.")
-
-        if current_version < 4:
+            # v3, v4 and v6 each rebuild 'meal_logs' and v5 only indexes it, so older databases
+            # get a single rebuild straight to the v6 table
+            logger.info("Applying schemas v3 to v6...")
+            _run_migration_v3_to_v6_fused(cursor)
+            cursor.execute("PRAGMA user_version = 6")
+            current_version = 6
+            logger.info("Schemas v3 to v6 applied.")
+        elif current_version < 4:
             logger.info("Applying schema v4...")
             _run_migration_v4(cursor)
             cursor.execute("PRAGMA user_version = 4")
             logger.info("Schema v4 applied.")
 
-        if current_version == LATEST_SCHEMA_VERSION:
+        if current_version < 5:
+            logger.info("Applying schema v5...")
+            _run_migration_v5(cursor)
+            cursor.execute("PRAGMA user_version = 5")
+            logger.info("Schema v5 applied.")
+
+        if current_version < 6:
+            logger.info("Applying schema v6...")
+            _run_migration_v6(cursor)
+            cursor.execute("PRAGMA user_version = 6")
+            logger.info("Schema v6 applied.")
+
+        if migrating:
+            _remove_orphaned_meal_logs(cursor)
+            # Statistics are gathered once, after the last rebuild, so none are dropped along with a table
+            cursor.execute("ANALYZE")
+            logger.info("Analyzed database.")
+            conn.commit()
+            # Restore the usual settings, then checkpoint so the migrated pages are synced into the database file
+            _apply_connection_pragmas(conn)
+            cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        else:
             logger.info("Database is up to date.")
-
-        conn.commit()
     except sqlite3.Error as e:
         logger.critical("DATABASE MIGRATION ERROR", exc_info=e)
         conn.rollback()
@@ -196,22 +513,42 @@ def init_db():
 
 # instantiate the app
 app = Flask(__name__)
+# Route jsonify() and request.get_json() through orjson
+app.json = OrjsonProvider(app)
 
 # enable CORS
 # This will allow the Vue.js frontend to make requests to the backend.
 CORS(app, resources={r'/api/*': {'origins': '*'}})
 
+# Compress larger responses (e.g. long AI replies, busy days) for clients that accept it; small bodies aren't worth the CPU
+app.config.update(
+    COMPRESS_ALGORITHM=['br', 'gzip'],
+    COMPRESS_MIN_SIZE=1024,
+    COMPRESS_BR_LEVEL=4,
+    COMPRESS_LEVEL=4
+)
+Compress(app)
+
+@app.before_request
+def set_request_date():
+    """Reads the date once per request so every helper agrees on what 'today' is."""
+    g.today = date.today()
+
 # Configure the Gemini API
 try:
     api_key = os.environ["GOOGLE_API_KEY"]
-    genai.configure(api_key=api_key)
+    genai.configure(api_key=api_key, transport=GEMINI_TRANSPORT)
+    GEMINI_CONFIGURED = True
 except KeyError:
+    GEMINI_CONFIGURED = False
     logger.critical("GOOGLE_API_KEY environment variable not set. The service will not work.")
 
 SYSTEM_INSTRUCTION = """
 You are a meal logging assistant. Your primary function is to identify when a user wants to log a meal.
 
-If the user's request is to log a food item, respond ONLY with a JSON object in the following format:
+Always respond with a single JSON object.
+
+If the user's request is to log a food item, respond in the following format:
 {"action": "log_meal", "details": {"food": "...", "meal": "...", "quantity": ..., "calories": ..., "date_keyword": "..."}}
 
 From the user's prompt, extract a date reference keyword.
@@ -230,69 +567,141 @@ If multiple numbers are present, use context to determine the correct quantity.
 If the quantity is ambiguous or seems like a transcription error (e.g., '5 817 eggs'), choose the most plausible number that modifies the food item.
 If no quantity is mentioned, you can omit the field as the system will default to 1.
 
-Your response for a log_meal action MUST be ONLY the raw JSON object itself, with no surrounding text, explanation, or markdown code fences (like ```json).
-
-If the user's request is anything else (e.g., a question, a greeting, a general command), respond conversationally as a helpful assistant.
+If the user's request is anything else (e.g., a question, a greeting, a general command), reply conversationally as a helpful assistant, in the following format:
+{"action": "chat", "response_text": "..."}
 """
 
+# Constrains Gemini's output to JSON of this shape, so replies never need cleanup before parsing
+GEMINI_RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'action': {'type': 'string', 'format': 'enum', 'enum': ['log_meal', 'chat']},
+        'response_text': {'type': 'string'},
+        'details': {
+            'type': 'object',
+            'properties': {
+                'food': {'type': 'string'},
+                'meal': {'type': 'string', 'nullable': True},
+                'quantity': {'type': 'integer'},
+                'calories': {'type': 'integer'},
+                'date_keyword': {'type': 'string'}
+            }
+        }
+    },
+    'required': ['action']
+}
+
+def ojsonify(obj, status=200):
+    """Like jsonify, but serializes with orjson straight to bytes for large payloads."""
+    return Response(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS), status=status, mimetype='application/json') # pylint: disable=no-member
+
+# Bodies of the fixed error responses on the prompt path, encoded once at import
+# pylint: disable=no-member
+_BODY_NO_DATA = orjson.dumps({'error': 'No data provided'})
+_BODY_INVALID_PAYLOAD = orjson.dumps({'error': 'Invalid request payload'})
+_BODY_NO_TEXT = orjson.dumps({'error': 'No text provided'})
+_BODY_NON_NUMERIC_DETAILS = orjson.dumps({'error': 'Quantity and calories must be numbers.'})
+_BODY_DETAILS_OUT_OF_RANGE = orjson.dumps({'error': 'Log details contain a number that is out of range.'})
+_BODY_AI_NOT_CONFIGURED = orjson.dumps({'status': 'error', 'message': 'The AI service is not configured.'})
+_BODY_AI_MISSING_FOOD = orjson.dumps({'error': 'AI response missing food name.'})
+_BODY_AI_NON_NUMERIC_DETAILS = orjson.dumps({'error': 'AI response has a non-numeric quantity or calorie count.'})
+_BODY_DATABASE_ERROR = orjson.dumps({'error': 'A database error occurred.'})
+_BODY_AI_OVERLOADED = orjson.dumps({'status': 'error', 'message': 'The AI service is busy. Please try again shortly.'})
+_BODY_AI_TIMEOUT = orjson.dumps({'status': 'error', 'message': 'The AI service took too long to respond. Please try again.'})
+_BODY_UNEXPECTED_ERROR = orjson.dumps({'status': 'error', 'message': 'An unexpected error occurred.'})
+# pylint: enable=no-member
+
+def _json_response(body, status=200):
+    """Wraps an already-encoded JSON body. Builds a new Response each time, since headers are set per request."""
+    return Response(body, status=status, mimetype='application/json')
+
+_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+@functools.lru_cache(maxsize=512)
+def _validate_date(value: str) -> bool:
+    """Returns True if the string is a valid date in YYYY-MM-DD format."""
+    if not _DATE_RE.match(value):
+        return False # Cheap rejection before attempting a full parse
+    try:
+        date.fromisoformat(value)
+    except ValueError:
+        return False
+    return True
+
+def _new_meal_bucket():
+    """Returns an empty per-meal group for get_logs_for_date."""
+    return {'entries': [], 'total_meal_calories': 0}
+
 @app.route('/api/logs/<string:meal_date>', methods=['GET'])
 def get_logs_for_date(meal_date):
     """Retrieves and groups all meal logs for a specific date."""
-    try:
-        # Validate that the provided string is a valid date in YYYY-MM-DD format
-        date.fromisoformat(meal_date)
-    except (ValueError, TypeError):
-        return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD.'}), 400
+    if not _validate_date(meal_date):
+        return ojsonify({'error': 'Invalid date format. Use YYYY-MM-DD.'}, 400)
 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        # Make the connection return rows that can be accessed by column name
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT
-                ml.id,
-                f.id as food_id,
-                ml.meal,
-                ml.quantity,
-                ml.total_calories,
-                f.name as food,
-                f.calories as per_item_calories
-            FROM meal_logs ml
-            JOIN foods f ON ml.food_id = f.id
-            WHERE ml.meal_date = ?
-            ORDER BY ml.log_timestamp
-            """,
-            (meal_date,)
-        )
-        rows = cursor.fetchall()
-        conn.close()
-
-        # Process the rows into a structured dictionary
-        meals_data = defaultdict(lambda: {'entries': [], 'total_meal_calories': 0})
-        total_daily_calories = 0
-
-        for row in rows:
-            meal_type = row['meal']
-            # Use the historically stored total_calories for accuracy
-            historical_total_calories = row['total_calories'] or 0
-
-            meals_data[meal_type]['entries'].append(dict(row))
-            meals_data[meal_type]['total_meal_calories'] += historical_total_calories
-            total_daily_calories += historical_total_calories
-
-        return jsonify({
+        with get_conn(readonly=True) as conn:
+            cursor = conn.cursor()
+            # Plain tuples are cheaper than sqlite3.Row; columns are unpacked by position below
+            cursor.row_factory = None
+            # One read transaction, so the totals and the entries come from the same snapshot
+            cursor.execute("BEGIN")
+            meal_totals = dict(cursor.execute(SQL_SELECT_MEAL_TOTALS_FOR_DATE, (meal_date,)))
+            if not meal_totals:
+                # Nothing logged that day, so there are no entries to query
+                return ojsonify({'total_daily_calories': 0, 'meals': {}})
+            # There are at most a handful of meals, so the day's total comes from their totals
+            total_daily_calories = sum(meal_totals.values())
+            cursor.execute(SQL_SELECT_LOGS_FOR_DATE, (meal_date,))
+
+            # Process the rows into a structured dictionary
+            meals_data = defaultdict(_new_meal_bucket)
+
+            # Rows are consumed straight from the cursor, so no intermediate list of every row is built.
+            # The totals are computed by SQLite; only the entry columns go into the response
+            for log_id, food_id, meal, quantity, total_calories, food, per_item_calories in cursor:
+                meal_data = meals_data[meal]
+                meal_data['entries'].append({
+                    'id': log_id,
+                    'food_id': food_id,
+                    'meal': meal,
+                    'quantity': quantity,
+                    'total_calories': total_calories,
+                    'food': food,
+                    'per_item_calories': per_item_calories,
+                })
+                meal_data['total_meal_calories'] = meal_totals[meal]
+
+        return ojsonify({
             'total_daily_calories': total_daily_calories,
             'meals': dict(meals_data) # Convert defaultdict to a regular dict for JSON
         })
 
     except sqlite3.Error as e:
         logger.error("DATABASE ERROR on SELECT", exc_info=e)
-        return jsonify({'error': 'Could not retrieve meal logs.'}), 500
+        return ojsonify({'error': 'Could not retrieve meal logs.'}, 500)
 
-def perform_readback_or_confirmation(details):
-    """Checks quantity and returns the appropriate readback/confirmation action."""
+def _coerce_details(details):
+    """
+    Coerces the numeric fields of log details to integers in place, defaulting quantity to 1,
+    and the food name to a string. Raises ValueError or TypeError if they are not numbers.
+    """
+    if details.get('food') is not None:
+        details['food'] = str(details['food'])
+    details['quantity'] = int(details.get('quantity') or 1)
+    if details.get('calories') is not None:
+        details['calories'] = int(details['calories'])
+    return details
+
+def _fits_sqlite_integer(value):
+    """Returns False for an int that SQLite cannot store; any other value is left for SQLite to handle."""
+    return not isinstance(value, int) or SQLITE_MIN_INTEGER <= value <= SQLITE_MAX_INTEGER
+
+def perform_readback_or_confirmation(details, today: date | None = None):
+    """
+    Checks quantity and returns the appropriate readback/confirmation action.
+    Expects details already passed through _coerce_details().
+    'today' defaults to the date read at the start of the current request.
+    """
     food = details.get('food', 'unknown')
     meal = details.get('meal', 'unknown')
     quantity = details.get('quantity', 1)
@@ -301,20 +710,16 @@ def perform_readback_or_confirmation(details):
 
     calorie_text = ""
     if per_item_calories is not None:
-        try:
-            # Calculate total calories and add it to the details for the final log
-            total_calories = int(per_item_calories) * int(quantity)
-            details['total_calories'] = total_calories
-            calorie_text = f", which is about {total_calories} calories"
-        except (ValueError, TypeError):
-            # If calories or quantity aren't valid numbers, just skip the text
-            calorie_text = ""
+        # Calculate total calories and add it to the details for the final log
+        total_calories = per_item_calories * quantity
+        details['total_calories'] = total_calories
+        calorie_text = f", which is about {total_calories} calories"
 
     date_text = ""
     if meal_date_str:
         try:
             meal_date_obj = date.fromisoformat(meal_date_str)
-            today = date.today()
+            today = today or g.today
             yesterday = today - timedelta(days=1)
 
             if meal_date_obj == today:
@@ -328,172 +733,484 @@ def perform_readback_or_confirmation(details):
 
     if quantity > 6:
         logger.info("High quantity (%s) detected. Requiring explicit confirmation.", quantity)
-        return jsonify({
+        return ojsonify({
             'status': 'success',
             'action': 'explicit_confirmation_required',
             'details': details,
             'response_text': f"Did you really have {quantity} {food}{date_text}{calorie_text}? Please confirm to log."
         })
     logger.debug("Readback required for: %s", details)
-    return jsonify({
+    return ojsonify({
         'status': 'success',
         'action': 'readback_required',
         'details': details,
         'response_text': f"Got it: {quantity} {food} for {meal}{date_text}{calorie_text}. I'll log this in a moment unless you cancel."
     })
 
+def _is_valid_log_item(item):
+    """Checks that a confirmed log item is an object whose numeric fields are numbers or absent."""
+    return isinstance(item, dict) and all(
+        item.get(key) is None or isinstance(item[key], (int, float))
+        for key in ('food_id', 'quantity', 'total_calories')
+    )
+
 def handle_confirmed_log(data):
-    """Handles a request that has been confirmed by the user (or by timeout)."""
+    """
+    Handles a request that has been confirmed by the user (or by timeout).
+    The details may carry an 'items' list to log several foods for the same meal at once;
+    a single-item payload is treated as a one-element list.
+    """
     details = data.get('details', {})
-    food = details.get('food', 'unknown')
+    if not isinstance(details, dict):
+        return _json_response(_BODY_INVALID_PAYLOAD, 400)
     meal = details.get('meal', 'unknown')
-    quantity = details.get('quantity', 1)
     meal_date = details.get('meal_date') # This will be a string 'YYYY-MM-DD'
-    total_calories = details.get('total_calories') # Get the pre-calculated total
-
+    items = details.get('items')
+    if items is None:
+        items = [details]
+    # Reject what cannot be stored up front, rather than reporting a log that was never written
+    if not (isinstance(meal, str) and isinstance(meal_date, (str, type(None)))
+            and isinstance(items, list) and items and all(_is_valid_log_item(item) for item in items)):
+        return _json_response(_BODY_INVALID_PAYLOAD, 400)
+
+    # Use the pre-calculated totals from the readback step
+    item_totals = [item.get('total_calories') for item in items]
     calorie_text = ""
-    if total_calories is not None:
-        calorie_text = f" for a total of {total_calories} calories"
+    if None not in item_totals:
+        calorie_text = f" for a total of {sum(item_totals)} calories"
 
     # --- Persist data to the database ---
+    rows = [
+        (meal_date, item.get('food_id'), meal, item.get('quantity', 1), item.get('total_calories'))
+        for item in items
+    ]
+    if not all(_fits_sqlite_integer(value) for row in rows for value in row):
+        return _json_response(_BODY_DETAILS_OUT_OF_RANGE, 400)
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO meal_logs (meal_date, food_id, meal, quantity, total_calories) VALUES (?, ?, ?, ?, ?)",
-            (meal_date, details.get('food_id'), meal, quantity, total_calories)
-        )
-        conn.commit()
-        conn.close()
+        # Shares one transaction (and one fsync) with any other logs confirmed at the same moment
+        _meal_log_writer.write(rows).result(timeout=MEAL_LOG_WRITER_TIMEOUT_SECONDS)
+    except TimeoutError as e:
+        logger.error("Meal log INSERT not committed within %s seconds", MEAL_LOG_WRITER_TIMEOUT_SECONDS, exc_info=e)
     except sqlite3.Error as e:
         logger.error("DATABASE ERROR on INSERT", exc_info=e)
         # We can still return a success response to the user even if DB write fails
 
-    logger.info("CONFIRMED: Logging %s '%s' for '%s'%s.", quantity, food, meal, calorie_text)
+    logged_text = " and ".join(f"{item.get('quantity', 1)} {item.get('food', 'unknown')}" for item in items)
+    logger.info("CONFIRMED: Logging %s for '%s'%s.", logged_text, meal, calorie_text)
 
-    return jsonify({
+    return ojsonify({
         'status': 'success',
         'action': 'log_finalized',
-        'response_text': f"Done. I've logged {quantity} {food} for {meal}{calorie_text}."
+        'response_text': f"Done. I've logged {logged_text} for {meal}{calorie_text}."
     })
 
-def resolve_meal_date(date_keyword: str) -> str:
+VALID_MEALS = frozenset({'breakfast', 'lunch', 'dinner', 'snack'})
+
+# Day offsets from today for the date keywords the LLM is asked to return
+_KEYWORD_OFFSETS = {'': 0, 'today': 0, 'yesterday': -1}
+
+def resolve_meal_date(date_keyword: str, today: date | None = None) -> str:
     """
     Resolves a date keyword from the LLM into a YYYY-MM-DD string.
     This function is the single source of truth for date calculations.
+    'today' defaults to the date read at the start of the current request.
     """
-    today = date.today()
-    if not date_keyword or date_keyword.lower() == 'today':
-        return today.isoformat()
-    if date_keyword.lower() == 'yesterday':
-        return (today - timedelta(days=1)).isoformat()
-
-    # Placeholder for a future, more advanced natural language date parser for phrases like "last Tuesday"
-    # For now, if we don't recognize the keyword, we default to today.
-    logger.warning("Unrecognized date_keyword: '%s'. Defaulting to today.", date_keyword)
-    return today.isoformat()
-
-def get_or_create_food(food_name, llm_calories):
-    """Finds a food by name or creates it if it doesn't exist. Returns (food_id, canonical_calories)."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, calories FROM foods WHERE name = ?", (food_name,))
-    food_row = cursor.fetchone()
-
-    if food_row:
-        food_id, canonical_calories = food_row[0], food_row[1]
-        logger.debug("Found existing food '%s' (ID: %s) with %s calories.", food_name, food_id, canonical_calories)
-    else:
+    offset = _KEYWORD_OFFSETS.get((date_keyword or '').lower())
+    if offset is None:
+        # Placeholder for a future, more advanced natural language date parser for phrases like "last Tuesday"
+        # For now, if we don't recognize the keyword, we default to today.
+        logger.warning("Unrecognized date_keyword: '%s'. Defaulting to today.", date_keyword)
+        offset = 0
+    return ((today or g.today) + timedelta(days=offset)).isoformat()
+
+@functools.lru_cache(maxsize=64)
+def _upsert_foods_sql(count):
+    """Builds the multi-row food upsert, reusing the same string for each batch size."""
+    return SQL_UPSERT_FOODS_TEMPLATE.format(values=", ".join(["(?, ?)"] * count))
+
+def get_or_create_foods(conn, foods):
+    """
+    Finds foods by name or creates the ones that don't exist, in a single statement.
+    Takes a {food_name: llm_calories} dict and returns {food_name: (food_id, canonical_calories)}.
+    Runs on the caller's connection so the upsert shares the caller's transaction.
+    """
+    params = []
+    for food_name, llm_calories in foods.items():
         try:
             calories_to_insert = int(llm_calories) if llm_calories is not None else 0
         except (ValueError, TypeError):
             calories_to_insert = 0 # Default to 0 if LLM gives non-numeric calorie value
+        params.extend((food_name, calories_to_insert))
 
-        cursor.execute("INSERT INTO foods (name, calories) VALUES (?, ?)", (food_name, calories_to_insert))
-        food_id = cursor.lastrowid
-        canonical_calories = calories_to_insert
-        logger.debug("Created new food '%s' (ID: %s) with %s calories.", food_name, food_id, canonical_calories)
+    # A single atomic upsert: existing foods keep their canonical calories, new ones are created
+    cursor = conn.cursor()
+    cursor.execute(_upsert_foods_sql(len(foods)), params)
+    resolved = {name: (food_id, calories) for name, food_id, calories in cursor.fetchall()}
+    logger.debug("Resolved %s food(s): %s", len(resolved), resolved)
 
-    conn.commit()
-    conn.close()
-    return food_id, canonical_calories
+    return resolved
+
+class FoodLoader: # pylint: disable=too-few-public-methods
+    """
+    Coalesces concurrent food lookups into one upsert statement.
+    Lookups arriving within a short window are batched together, and requests for
+    the same name share one future. The first caller's calorie estimate wins for new foods.
+    """
+
+    def __init__(self, window_seconds, max_batch_size):
+        self._window_seconds = window_seconds
+        self._max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._pending = {} # food_name -> (llm_calories, Future)
+
+    def load(self, food_name, llm_calories):
+        """Queues a lookup and returns a Future resolving to (food_id, canonical_calories)."""
+        with self._lock:
+            if food_name in self._pending:
+                return self._pending[food_name][1]
+            future = Future()
+            self._pending[food_name] = (llm_calories, future)
+            if len(self._pending) == 1:
+                # First lookup of a new batch; the timer thread is created per batch so none survive a fork
+                timer = threading.Timer(self._window_seconds, self._flush)
+                timer.daemon = True
+                timer.start()
+        return future
+
+    def _flush(self):
+        """Resolves every pending lookup, chunked to stay under SQLite's bound-parameter limit."""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+
+        names = list(batch)
+        for start in range(0, len(names), self._max_batch_size):
+            chunk = {name: batch[name][0] for name in names[start:start + self._max_batch_size]}
+            try:
+                with db_transaction() as conn:
+                    resolved = get_or_create_foods(conn, chunk)
+            except Exception as e: # pylint: disable=broad-exception-caught
+                # Anything escaping here would kill the timer thread and leave callers waiting forever
+                for name in chunk:
+                    batch[name][1].set_exception(e)
+                continue
+            for name in chunk:
+                # Names come back from a TEXT column, so look them up as strings
+                if str(name) in resolved:
+                    batch[name][1].set_result(resolved[str(name)])
+                else:
+                    batch[name][1].set_exception(LookupError(f"Food '{name}' was not resolved"))
+
+_food_loader = FoodLoader(FOOD_LOADER_WINDOW_SECONDS, FOOD_LOADER_MAX_BATCH_SIZE)
+
+class MealLogWriter: # pylint: disable=too-few-public-methods
+    """
+    Group-commits concurrent meal log inserts.
+    Rows queued within a short window are written with one executemany in one transaction.
+    Callers wait on the returned future, so a log is committed before its request is answered.
+    """
+
+    def __init__(self, window_seconds):
+        self._window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._pending = [] # (rows, Future)
+
+    def write(self, rows):
+        """Queues rows for SQL_INSERT_MEAL_LOG and returns a Future resolving once they are committed."""
+        future = Future()
+        with self._lock:
+            self._pending.append((rows, future))
+            if len(self._pending) == 1:
+                # First write of a new batch; the timer thread is created per batch so none survive a fork
+                timer = threading.Timer(self._window_seconds, self._flush)
+                timer.daemon = True
+                timer.start()
+        return future
+
+    def _flush(self):
+        """Commits every pending write together, falling back to one transaction per caller on failure."""
+        with self._lock:
+            batch, self._pending = self._pending, []
+
+        try:
+            with db_transaction() as conn:
+                conn.executemany(SQL_INSERT_MEAL_LOG, [row for rows, _ in batch for row in rows])
+        except Exception as e: # pylint: disable=broad-exception-caught
+            # Anything escaping here would kill the timer thread and leave callers waiting forever
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # Retry each caller's rows on their own, so one bad payload cannot fail the others
+            for rows, future in batch:
+                try:
+                    with db_transaction() as conn:
+                        conn.executemany(SQL_INSERT_MEAL_LOG, rows)
+                except Exception as retry_error: # pylint: disable=broad-exception-caught
+                    future.set_exception(retry_error)
+                else:
+                    future.set_result(None)
+            return
+
+        for _, future in batch:
+            future.set_result(None)
+
+_meal_log_writer = MealLogWriter(MEAL_LOG_WRITER_WINDOW_SECONDS)
 
 def handle_meal_clarification(data):
     """Handles the user's response to a meal clarification prompt."""
     details = data.get('details')
-    meal_clarification = data.get('meal', '').lower().strip()
-    valid_meals = ["breakfast", "lunch", "dinner", "snack"]
+    meal_clarification = data.get('meal', '').strip().casefold()
 
-    if meal_clarification not in valid_meals:
+    if meal_clarification not in VALID_MEALS:
         logger.warning("Invalid meal clarification: '%s'. Cancelling log.", meal_clarification)
-        return jsonify({
+        return ojsonify({
             'status': 'error',
             'action': 'log_cancelled',
             'response_text': f"'{meal_clarification}' is not a valid meal. Please try logging again."
         })
 
+    try:
+        _coerce_details(details)
+    except (ValueError, TypeError):
+        return _json_response(_BODY_NON_NUMERIC_DETAILS, 400)
+
     logger.info("Meal clarified to '%s'.", meal_clarification)
     details['meal'] = meal_clarification
     # The meal is now clarified, proceed to the next step
     return perform_readback_or_confirmation(details)
 
-def _call_llm_and_parse_json(prompt_text, system_instruction):
+class GeminiOverloadedError(Exception):
+    """Raised when a Gemini call is refused because the estimated backlog is too large."""
+
+class GeminiAdmission: # pylint: disable=too-few-public-methods
+    """
+    Sheds Gemini calls before they queue up behind a slow upstream.
+    By Little's law, in-flight calls times their average latency estimates the outstanding work;
+    new calls are refused while that estimate is over budget.
+    Counts only this process's calls, so each gunicorn worker enforces its own budget.
+    """
+
+    def __init__(self, max_backlog_seconds, smoothing):
+        self.max_backlog_seconds = max_backlog_seconds
+        self._smoothing = smoothing
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._avg_latency = 0.0
+
+    @contextmanager
+    def admit(self):
+        """Holds a slot for one Gemini call and records its latency. Raises GeminiOverloadedError if over budget."""
+        with self._lock:
+            if self._inflight * self._avg_latency > self.max_backlog_seconds:
+                raise GeminiOverloadedError()
+            self._inflight += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self._inflight -= 1
+                if self._avg_latency:
+                    self._avg_latency += self._smoothing * (elapsed - self._avg_latency)
+                else:
+                    self._avg_latency = elapsed
+
+_gemini_admission = GeminiAdmission(GEMINI_MAX_BACKLOG_SECONDS, GEMINI_LATENCY_SMOOTHING)
+
+def split_gemini_backlog_budget(workers):
+    """
+    Limits this process to an equal share of GEMINI_MAX_BACKLOG_SECONDS.
+    Called from gunicorn's post_fork hook with the number of workers actually started.
+    """
+    _gemini_admission.max_backlog_seconds = GEMINI_MAX_BACKLOG_SECONDS / workers
+_llm_cache = TTLCache(maxsize=LLM_CACHE_MAXSIZE, ttl=LLM_CACHE_TTL_SECONDS)
+_llm_cache_lock = threading.Lock() # TTLCache is not thread-safe on its own
+_llm_inflight = {} # cache_key -> Future shared by concurrent callers of the same prompt; guarded by _llm_cache_lock
+
+# Punctuation, except between digits so quantities like "1.5" and "1/2" keep their meaning
+_CACHE_KEY_PUNCT_RE = re.compile(r'(?<!\d)[^\w\s]|[^\w\s](?!\d)')
+
+def _llm_cache_key(prompt_text):
+    """
+    Builds a compact cache key from the normalized prompt text.
+    Case, punctuation and runs of whitespace are ignored, so "Log 2 eggs for breakfast!" and
+    "log 2 eggs  for breakfast" share an entry.
+    """
+    normalized = ' '.join(_CACHE_KEY_PUNCT_RE.sub('', prompt_text.casefold()).split())
+    return hashlib.blake2b(normalized.encode()).digest()
+
+_gemini_model = None # pylint: disable=invalid-name
+_gemini_model_lock = threading.Lock()
+
+def _get_gemini_model():
+    """Returns the shared Gemini model, creating it on first use. Returns None if the API key is missing."""
+    global _gemini_model # pylint: disable=global-statement
+    if _gemini_model is None and GEMINI_CONFIGURED:
+        with _gemini_model_lock:
+            if _gemini_model is None:
+                _gemini_model = genai.GenerativeModel(
+                    GEMINI_MODEL_NAME,
+                    system_instruction=SYSTEM_INSTRUCTION,
+                    generation_config=genai.GenerationConfig(
+                        response_mime_type='application/json',
+                        response_schema=GEMINI_RESPONSE_SCHEMA
+                    )
+                )
+    return _gemini_model
+
+def _generate_and_parse(prompt_text):
     """
     Calls the Gemini API and parses the JSON response.
-    Returns a tuple: (parsed_data, is_actionable_json).
-    Raises exceptions for API or parsing failures.
+    Returns a tuple: (parsed_data, is_actionable_json), where parsed_data is the conversational
+    reply text when the response is not a 'log_meal' action.
     """
-    model = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=system_instruction)
-    response = model.generate_content(prompt_text)
+    response = _get_gemini_model().generate_content(
+        prompt_text,
+        request_options={'timeout': GEMINI_TIMEOUT_SECONDS}
+    )
 
+    # JSON mode guarantees a bare JSON object, so there are no markdown fences to strip
     raw_text = response.text
-    if raw_text.strip().startswith("```json"):
-        cleaned_text = raw_text.strip()[7:-3].strip()
-    else:
-        cleaned_text = raw_text.strip()
-
     try:
-        response_data = json.loads(cleaned_text)
+        response_data = orjson.loads(raw_text) # pylint: disable=no-member
         is_actionable = response_data.get('action') == 'log_meal'
-        return response_data, is_actionable
-    except (json.JSONDecodeError, AttributeError):
+    except (orjson.JSONDecodeError, AttributeError): # pylint: disable=no-member
         # Not valid JSON or doesn't have the expected structure, treat as conversational.
         return raw_text, False
 
+    if not is_actionable:
+        return response_data.get('response_text', raw_text), False
+    return response_data, True
+
+def _call_llm_and_parse_json(prompt_text):
+    """
+    Returns the parsed Gemini response for a prompt as (parsed_data, is_actionable_json).
+    Raises exceptions for API failures, or GeminiOverloadedError when the call is shed.
+    Actionable responses are cached; conversational replies are never cached.
+    Identical prompts already in flight share one Gemini call instead of issuing their own.
+    """
+    cache_key = _llm_cache_key(prompt_text)
+    with _llm_cache_lock:
+        cached_data = _llm_cache.get(cache_key)
+        if cached_data is None:
+            future = _llm_inflight.get(cache_key)
+            is_leader = future is None
+            if is_leader:
+                future = _llm_inflight[cache_key] = Future()
+    if cached_data is not None:
+        logger.debug("LLM cache hit for prompt: '%s'", prompt_text)
+        # Callers mutate the details, so never hand out the cached object itself
+        return copy.deepcopy(cached_data), True
+
+    if not is_leader:
+        logger.debug("Joining in-flight Gemini call for prompt: '%s'", prompt_text)
+        response_data, is_actionable = future.result()
+        return copy.deepcopy(response_data), is_actionable
+
+    logger.debug("LLM cache miss for prompt: '%s'", prompt_text)
+    try:
+        with _gemini_admission.admit():
+            response_data, is_actionable = _generate_and_parse(prompt_text)
+    except Exception as e: # pylint: disable=broad-exception-caught
+        with _llm_cache_lock:
+            del _llm_inflight[cache_key]
+        future.set_exception(e)
+        raise
+
+    shared_data = copy.deepcopy(response_data)
+    with _llm_cache_lock:
+        if is_actionable:
+            _llm_cache[cache_key] = shared_data
+        del _llm_inflight[cache_key]
+    future.set_result((shared_data, is_actionable))
+    return response_data, is_actionable
+
+# Longer prompts always go to the AI; no simple log needs more than this
+SIMPLE_LOG_MAX_PROMPT_LENGTH = 200
+# Matches simple prompts such as "log 2 eggs for breakfast" or "I had a bagel for lunch yesterday".
+# Food words are separated by single whitespace characters, so the food can never claim the same
+# whitespace run as the "for" that follows it, which would make failed matches backtrack heavily.
+_SIMPLE_LOG_RE = re.compile(
+    r"^(?:log|i ate|i had)\s+(?:(?P<qty>\d+)\s+)?(?:(?:a|an)\s+)?(?P<food>[\w-]+(?:\s[\w-]+)*?)"
+    r"\s+for\s+(?P<meal>breakfast|lunch|dinner|snack)(?:\s+(?P<date>today|yesterday))?\s*[.!]?$",
+    re.IGNORECASE
+)
+
+def _match_simple_log_prompt(prompt_text):
+    """
+    Builds log details without calling the AI when the prompt is a simple log of a food we already know.
+    Unknown foods return None so the AI can estimate their calories.
+    """
+    if len(prompt_text) > SIMPLE_LOG_MAX_PROMPT_LENGTH:
+        return None
+    match = _SIMPLE_LOG_RE.match(prompt_text)
+    if not match:
+        return None
+
+    food_name = match['food'].strip()
+    with get_conn() as conn:
+        food_row = conn.execute(SQL_SELECT_FOOD_BY_NAME, (food_name,)).fetchone()
+    if not food_row:
+        return None
+
+    date_keyword = (match['date'] or 'today').lower()
+    logger.debug("Simple log prompt matched for known food '%s'; skipping the AI.", food_name)
+    return {
+        'food': food_name,
+        'food_id': food_row['id'],
+        'calories': food_row['calories'],
+        'meal': match['meal'].lower(),
+        'quantity': int(match['qty'] or 1),
+        'date_keyword': date_keyword,
+        'meal_date': resolve_meal_date(date_keyword)
+    }
+
 def handle_initial_prompt(data):
-    """Handles the initial text prompt from the user by calling the AI."""
+    """Handles the initial text prompt from the user, calling the AI unless a simple log can be parsed directly."""
     if not data or 'text' not in data:
-        return jsonify({'error': 'No text provided'}), 400
+        return _json_response(_BODY_NO_TEXT, 400)
 
     prompt_text = data['text'].strip()
 
     try:
-        response_data, is_actionable = _call_llm_and_parse_json(prompt_text, SYSTEM_INSTRUCTION)
+        details = _match_simple_log_prompt(prompt_text)
+        if details:
+            return perform_readback_or_confirmation(details)
+
+        if _get_gemini_model() is None:
+            return _json_response(_BODY_AI_NOT_CONFIGURED, 503)
+
+        response_data, is_actionable = _call_llm_and_parse_json(prompt_text)
 
         if not is_actionable:
             # The response was conversational text or non-actionable JSON.
             logger.debug("Gemini response: '%s'", response_data)
-            return jsonify({'status': 'success', 'action': 'ai_response', 'response_text': str(response_data)})
+            return ojsonify({'status': 'success', 'action': 'ai_response', 'response_text': str(response_data)})
 
         details = response_data.get('details', {})
         food_name = details.get('food')
         if not food_name:
-            return jsonify({'error': 'AI response missing food name.'}), 400
+            return _json_response(_BODY_AI_MISSING_FOOD, 400)
+        try:
+            _coerce_details(details)
+        except (ValueError, TypeError):
+            return _json_response(_BODY_AI_NON_NUMERIC_DETAILS, 400)
+        food_name = details['food']
 
-        food_id, canonical_calories = get_or_create_food(food_name, details.get('calories'))
+        # Start the food lookup in the background while the rest of the details are resolved
+        food_future = _food_loader.load(food_name, details.get('calories'))
+        details['meal_date'] = resolve_meal_date(details.get('date_keyword'))
+        food_id, canonical_calories = food_future.result() # Re-raises any error from the lookup here
         details.update({
             'food_id': food_id,
-            'calories': canonical_calories,
-            'meal_date': resolve_meal_date(details.get('date_keyword')),
-            'quantity': details.get('quantity') or 1
+            'calories': canonical_calories
         })
 
         # --- Meal Type Validation ---
         meal = details.get('meal')
-        valid_meals = ["breakfast", "lunch", "dinner", "snack"]
-        if not meal or str(meal).lower().strip() not in valid_meals:
+        if not meal or str(meal).strip().casefold() not in VALID_MEALS:
             logger.warning("Meal is missing or invalid ('%s') for food '%s'. Asking for clarification.", meal, food_name)
-            return jsonify({
+            return ojsonify({
                 'status': 'success',
                 'action': 'meal_clarification_required',
                 'details': details,
@@ -504,33 +1221,48 @@ def handle_initial_prompt(data):
 
     except sqlite3.Error as e:
         logger.error("DATABASE ERROR during initial prompt", exc_info=e)
-        return jsonify({'error': 'A database error occurred.'}), 500
+        return _json_response(_BODY_DATABASE_ERROR, 500)
+    except GeminiOverloadedError:
+        logger.warning("Shedding prompt; the Gemini backlog is over %s seconds.", _gemini_admission.max_backlog_seconds)
+        return _json_response(_BODY_AI_OVERLOADED, 429)
+    except google_exceptions.DeadlineExceeded as e:
+        logger.error("Gemini did not respond within %s seconds", GEMINI_TIMEOUT_SECONDS, exc_info=e)
+        return _json_response(_BODY_AI_TIMEOUT, 504)
     except Exception as e: # Catch-all for other unexpected errors, including from the API call
         logger.error("An unexpected error occurred in handle_initial_prompt", exc_info=e)
-        return jsonify({'status': 'error', 'message': 'An unexpected error occurred.'}), 500
+        return _json_response(_BODY_UNEXPECTED_ERROR, 500)
+
+# Maps each follow-up 'action' to the payload keys it requires and the handler that serves it
+_PROMPT_ACTIONS = {
+    'confirm_log': (('details',), handle_confirmed_log),
+    'clarify_meal': (('details', 'meal'), handle_meal_clarification),
+}
 
 @app.route('/api/prompt', methods=['POST'])
 def handle_prompt():
     """Main route to handle all prompt-related requests."""
-    data = request.get_json()
+    data = request.get_json(silent=True)
     if not data:
-        return jsonify({'error': 'No data provided'}), 400
+        return _json_response(_BODY_NO_DATA, 400)
+    if not isinstance(data, dict):
+        return _json_response(_BODY_INVALID_PAYLOAD, 400)
 
     # Route to the correct handler based on the request payload
-    if 'text' in data:
-        prompt_text = data.get('text')
+    prompt_text = data.get('text')
+    if prompt_text is not None:
+        if not isinstance(prompt_text, str):
+            return _json_response(_BODY_INVALID_PAYLOAD, 400)
         logger.debug("Received initial prompt: '%s'", prompt_text.strip())
         return handle_initial_prompt(data)
 
-    if data.get('action') == 'confirm_log' and 'details' in data:
-        logger.debug("Received confirmation to log.")
-        return handle_confirmed_log(data)
-
-    if data.get('action') == 'clarify_meal' and 'details' in data and 'meal' in data:
-        logger.debug("Received meal clarification.")
-        return handle_meal_clarification(data)
+    action = data.get('action')
+    route = _PROMPT_ACTIONS.get(action) if isinstance(action, str) else None
+    if route is None or not all(key in data for key in route[0]):
+        return _json_response(_BODY_INVALID_PAYLOAD, 400)
+    _, handler = route
 
-    return jsonify({'error': 'Invalid request payload'}), 400
+    logger.debug("Received '%s' action.", action)
+    return handler(data)
 
 @app.route('/api/foods/<int:food_id>', methods=['PATCH'])
 def update_food_entry(food_id):
@@ -547,11 +1279,8 @@ def update_food_entry(food_id):
         return jsonify({'error': 'Invalid calories format.'}), 400
 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE foods SET calories = ? WHERE id = ?", (new_calories, food_id))
-        conn.commit()
-        conn.close()
+        with db_transaction() as conn:
+            conn.execute(SQL_UPDATE_FOOD_CALORIES, (new_calories, food_id))
         return jsonify({'status': 'success', 'message': f'Food entry {food_id} updated.'})
     except sqlite3.Error as e:
         logger.error("DATABASE ERROR on food UPDATE", exc_info=e)
@@ -562,9 +1291,7 @@ def _validate_update_log_request(meal_date, request_data) -> tuple[str | None, i
     Validates input for updating a log entry.
     Returns a tuple of (error_message, new_quantity).
     """
-    try:
-        date.fromisoformat(meal_date)
-    except (ValueError, TypeError):
+    if not _validate_date(meal_date):
         return 'Invalid date format in URL. Use YYYY-MM-DD.', None
 
     if not request_data or 'quantity' not in request_data:
@@ -588,33 +1315,21 @@ def update_log_entry(meal_date, log_id):
         return jsonify({'error': error_message}), 400
 
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-
-            # Fetch existing entry to validate and get info
-            cursor.execute("SELECT food_id, meal_date FROM meal_logs WHERE id = ?", (log_id,))
-            entry = cursor.fetchone()
-            if not entry:
-                return jsonify({'error': 'Log entry not found.'}), 404
-            if entry['meal_date'] != meal_date:
+        with db_transaction() as conn:
+            # fetchall() steps the statement to completion before the transaction commits
+            updated = conn.execute(SQL_UPDATE_LOG_QUANTITY, (new_quantity, new_quantity, log_id, meal_date)).fetchall()
+
+            if not updated:
+                # Nothing matched; only now look up the entry to report why
+                entry = conn.execute(SQL_SELECT_LOG_ENTRY_DATE, (log_id,)).fetchone()
+                if not entry:
+                    return jsonify({'error': 'Log entry not found.'}), 404
                 return jsonify({'error': 'Log entry does not belong to the specified date.'}), 400
 
-            # Fetch canonical calories
-            cursor.execute("SELECT calories FROM foods WHERE id = ?", (entry['food_id'],))
-            food_row = cursor.fetchone()
-            if not food_row:
+            if updated[0]['total_calories'] is None:
+                conn.rollback()
                 return jsonify({'error': 'Associated food item not found, cannot update calories.'}), 500
-
-            per_item_calories = food_row[0]
-            new_total_calories = round(per_item_calories * new_quantity)
-
-            # Update the database
-            cursor.execute(
-                "UPDATE meal_logs SET quantity = ?, total_calories = ? WHERE id = ?",
-                (new_quantity, new_total_calories, log_id)
-            )
-            # The 'with' statement handles the commit on success or rollback on error.
+            # db_transaction() handles the commit on success or rollback on error.
 
     except sqlite3.Error as e:
         logger.error("DATABASE ERROR on UPDATE", exc_info=e)
@@ -625,36 +1340,25 @@ def update_log_entry(meal_date, log_id):
 @app.route('/api/logs/<string:meal_date>/entry/<int:log_id>', methods=['DELETE'])
 def delete_log_entry(meal_date, log_id):
     """Deletes a specific log entry."""
-    try:
-        # Validate that the provided string is a valid date in YYYY-MM-DD format
-        date.fromisoformat(meal_date)
-    except (ValueError, TypeError):
+    if not _validate_date(meal_date):
         return jsonify({'error': 'Invalid date format in URL. Use YYYY-MM-DD.'}), 400
 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
+        with db_transaction() as conn:
+            # Only deletes the entry if it belongs to the date; RETURNING reports whether it did.
+            # fetchall() steps the statement to completion before the transaction commits.
+            deleted = conn.execute(SQL_DELETE_LOG_ENTRY, (log_id, meal_date)).fetchall()
 
-        # Optional but good practice: Check if the entry exists and belongs to the date before deleting
-        cursor.execute("SELECT id FROM meal_logs WHERE id = ? AND meal_date = ?", (log_id, meal_date))
-        entry = cursor.fetchone()
-
-        if not entry:
+        if not deleted:
             return jsonify({'error': 'Log entry not found or does not belong to the specified date.'}), 404
-
-        # Delete the entry
-        cursor.execute("DELETE FROM meal_logs WHERE id = ?", (log_id,))
-        conn.commit()
         return jsonify({'status': 'success', 'message': f'Log entry {log_id} deleted.'})
     except sqlite3.Error as e:
         logger.error("DATABASE ERROR on DELETE", exc_info=e)
         return jsonify({'error': 'Could not delete log entry.'}), 500
-    finally:
-        if conn:
-            conn.close()
 
 # Initialize the database when the application module is loaded.
 init_db()
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # Development server only; debug mode is opt-in through FLASK_DEBUG
+    app.run()
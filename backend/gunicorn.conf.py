@@ -0,0 +1,32 @@
+# pylint: disable=invalid-name
+
+"""
+Gunicorn settings for serving the meal logging API.
+Start with: gunicorn -c gunicorn.conf.py app:app
+"""
+
+import os
+
+bind = '0.0.0.0:5000'
+
+# Requests spend most of their time waiting on Gemini, so use threaded workers on every core
+workers = 2 * (os.cpu_count() or 1) + 1
+worker_class = 'gthread'
+# Each thread holds one request, including its Gemini wait,
+# so this caps in-flight requests per worker.
+# Keep DB_POOL_SIZE in step so every thread can hold a pooled SQLite connection.
+threads = int(os.getenv('GUNICORN_THREADS', '16'))
+
+# Import the app once in the master so database migrations run before any worker forks
+preload_app = True
+
+timeout = 30
+graceful_timeout = 10
+# Hold idle client connections open between requests instead of reconnecting
+keepalive = 15
+
+def post_fork(server, worker): # pylint: disable=unused-argument
+    """Splits the app's per-process Gemini backlog budget across the workers actually running."""
+    # Already imported in the master by preload_app, so this only looks up the loaded module
+    import app # pylint: disable=import-outside-toplevel
+    app.split_gemini_backlog_budget(server.num_workers)